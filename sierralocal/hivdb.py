@@ -1,10 +1,27 @@
-import xml.etree.ElementTree as xml
+try:
+    from lxml import etree as xml  # libxml2-backed parser, if available
+except ImportError:
+    import xml.etree.ElementTree as xml
 import glob
+import hashlib
 import os
+import pickle
 from pathlib import Path
 import re
 import sys
 import subprocess
+import tempfile
+
+# regular expressions for parsing ASI2 drug conditions, compiled once at import
+_MAX_CHUNK_RE = re.compile(r'(\(?\d+[A-Za-z]+[\s?AND\s?\d+\w]+\)?\s?=>\s?\d+|\(?\d+[A-Za-z]+[\s?AND\s?\d+\w]+\)?\s?=>\s?-\d+)')
+_GROUP_RE = re.compile(r'(\d+)([A-Za-z]+)')
+_SCORE_RE = re.compile(r'=>\s*(-?\d+)')
+
+# bump when the structure of the parsed algorithm changes, to invalidate existing caches
+_CACHE_VERSION = 4
+
+# package data directory, located once at import
+_DATA_DIR = Path(__file__).parent/'data'
 
 
 class HIVdb():
@@ -25,54 +42,63 @@ class HIVdb():
                 subprocess.check_call("git submodule foreach git pull origin main", shell=True)
             except:
                 print("Could not update submodules")
-        else:
-            self.set_hivdb_xml(asi2)
-            self.set_apobec_json(apobec)
-
-        # Set algorithm metadata
-        self.root = xml.parse(str(self.xml_filename)).getroot()
-        self.algname = self.root.find('ALGNAME').text
-        self.version = self.root.find('ALGVERSION').text
-        self.version_date = self.root.find('ALGDATE').text
+        self.set_hivdb_xml(asi2)
+        self.set_apobec_json(apobec)
+
+        # Load the parsed algorithm from the cache written by an earlier run, which skips
+        # parsing the XML entirely.  Otherwise (or after an update) parse the XML and
+        # write the cache
+        self.root = None
+        self.cache_filename = self.get_cache_filename()
+        if forceupdate or not self.load_algorithm():
+            try:
+                self.root = xml.parse(str(self.xml_filename)).getroot()
+            except:
+                print('Failed to parse XML file. Please post an issue at '
+                      'http://github.com/PoonLab/sierra-local/issues.')
+                raise
+            # Set algorithm metadata
+            self.algname = self.root.find('ALGNAME').text
+            self.version = self.root.find('ALGVERSION').text
+            self.version_date = self.root.find('ALGDATE').text
+            self.parse_definitions(self.root)
+            self.parse_drugs(self.root)
+            self.parse_comments(self.root)
+            self.dump_algorithm()
         print("HIVdb version", self.version)
 
+    def __getstate__(self):
+        # the XML tree is not needed once parsed, and lxml elements cannot be pickled
+        # (e.g., when passing the algorithm to scoring worker processes)
+        state = self.__dict__.copy()
+        state['root'] = None
+        return state
+
     def set_hivdb_xml(self, path):
         file_found = False
         if path is None:
             # If user has not specified XML path
             # Iterate over possible HIVdb ASI files matching the glob pattern
-            dest = str(Path(os.path.dirname(__file__))/'data'/'hivfacts'/'data'/'algorithms'/'HIVDB_*.xml')
+            dest = str(_DATA_DIR/'hivfacts'/'data'/'algorithms'/'HIVDB_*.xml')
             print("searching path " + dest)
             files = glob.glob(dest)
 
-            # find the newest XML that can be parsed
+            # take the newest XML, which is parsed by __init__ unless it is cached
             intermed = []
             for file in files:
                 version = re.search("HIVDB_([0-9]\.[0-9.-]+)\.", file).group(1)
                 intermed.append((version, file))
             intermed.sort(reverse=True)
 
-            for version, file in intermed:
-                try:
-                    xml.parse(file)
-                    file_found = True  # if no exception thrown
-                    self.xml_filename = file
-                    break
-                except:
-                    print('Failed to parse XML file. Please post an issue at '
-                          'http://github.com/PoonLab/sierra-local/issues.')
-                    raise
+            if intermed:
+                file_found = True
+                self.xml_filename = intermed[0][1]
         else:
             # The user has specified XML path
             if os.path.isfile(path):
                 # Ensure is a file
-                try:
-                    # Ensure is XML parseable
-                    xml.parse(path)
-                    file_found = True
-                    self.xml_filename = path
-                except:
-                    raise
+                file_found = True
+                self.xml_filename = path
             else:
                 print("HIVDB XML cannot be found at user specified "
                       "path {}".format(path))
@@ -89,7 +115,7 @@ class HIVdb():
         Attempt to locate a local APOBEC DRM file (json format)
         """
         if path is None:
-            dest = str(Path(os.path.dirname(__file__))/'data'/'hivfacts'/'data'/'apobecs'/'apobec_*.json')
+            dest = str(_DATA_DIR/'hivfacts'/'data'/'apobecs'/'apobec_*.json')
             print("searching path {}".format(dest))
             files = glob.glob(dest)
             for file in files:
@@ -107,6 +133,55 @@ class HIVdb():
         print("Please ensure that the submodule (https://github.com/hivdb/hivfacts/tree/) has been initialized and updated")
         sys.exit()
 
+    def get_cache_filename(self):
+        """
+        Path to the pickled copy of the parsed algorithm, which is keyed on the SHA1 hash
+        of the XML file contents so that a modified XML is never matched to a stale cache.
+        This is kept in the user's own cache directory rather than the package data
+        directory, which the installer makes world-writable.
+        """
+        with open(self.xml_filename, 'rb') as handle:
+            digest = hashlib.sha1(handle.read()).hexdigest()[:12]
+        cache_dir = Path(os.environ.get('XDG_CACHE_HOME', Path.home()/'.cache'))/'sierralocal'
+        filename = '{}.{}.v{}.pkl'.format(os.path.basename(self.xml_filename), digest, _CACHE_VERSION)
+        return str(cache_dir/filename)
+
+    def load_algorithm(self):
+        """
+        Load the metadata, definitions, drugs and comments of the algorithm from the
+        pickled copy written by a previous run, if the XML is unchanged.
+
+        @return: True if the algorithm was loaded from the cache, False otherwise
+        """
+        if not os.path.isfile(self.cache_filename):
+            return False
+        try:
+            with open(self.cache_filename, 'rb') as handle:
+                (self.algname, self.version, self.version_date, self.definitions,
+                 self.drugs, self.drug_aliases, self.drug_conditions, self.comments) = pickle.load(handle)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            print("Failed to load cached algorithm {}, parsing XML".format(self.cache_filename))
+            return False
+        return True
+
+    def dump_algorithm(self):
+        """
+        Write the parsed algorithm to the cache, for load_algorithm() in later runs
+        """
+        cache_dir = os.path.dirname(self.cache_filename)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file and move it into place, so that a concurrent run
+            # never loads a partially written cache
+            with tempfile.NamedTemporaryFile('wb', dir=cache_dir, suffix='.tmp',
+                                             delete=False) as handle:
+                pickle.dump((self.algname, self.version, self.version_date, self.definitions,
+                             self.drugs, self.drug_aliases, self.drug_conditions, self.comments),
+                            handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(handle.name, self.cache_filename)
+        except OSError:
+            pass  # cache is optional, e.g., if we cannot write to the cache directory
+
     def parse_definitions(self, root):
         """
         parse_definitions function meant to assemble definitions into nested dictionary
@@ -123,19 +198,16 @@ class HIVdb():
             'globalrange': {},  # maps from score to level
             'comment': {}  # maps comments to id string
         }
-        # Convert list of elements from class 'xml.etree.ElementTree.Element' to type 'str'
-        element_list = list(map(lambda x: xml.tostring(x).strip().decode("utf-8"), root.getchildren()))
-        # Find the index of element 'DEFINITIONS' so that it's children may be iterated over to parse definitions
-        def_index = [i for i, item in enumerate(element_list) if re.search('<DEFINITIONS>', item)]
-        def_ind = def_index[0]  # un-list the index of 'DEFINITIONS' element
-
-        definitions = root.getchildren()[def_ind]
-        comment_definitions = definitions.getchildren()[-1]  # TODO: swap out hard-coded index with variable
+        # Locate element 'DEFINITIONS' by its tag so that it's children may be iterated over
+        # to parse definitions, without serializing every child of root to a string
+        definitions = root.find('DEFINITIONS')
+        if definitions is None:
+            raise ValueError("No DEFINITIONS element in HIVdb XML file {}".format(self.xml_filename))
 
         globalrange = definitions.find('GLOBALRANGE').text.split(',')
         default_grange = self.parse_globalrange(self.definitions['globalrange'], globalrange)
 
-        for element in definitions.getchildren():
+        for element in definitions:
             if element.tag == 'GENE_DEFINITION':
                 gene = element.find('NAME').text
                 drug_classes = element.find('DRUGCLASSLIST').text.split(',')
@@ -153,7 +225,7 @@ class HIVdb():
                 self.definitions['drugclass'].update({name: druglist})
 
             elif element.tag == 'COMMENT_DEFINITIONS':
-                for comment_str in comment_definitions.getchildren():
+                for comment_str in element:
                     id = comment_str.attrib['id']
                     comment = comment_str.find('TEXT').text
                     sort_tag = comment_str.find('SORT_TAG').text
@@ -198,29 +270,76 @@ class HIVdb():
             and assigns a library of the drug resistant mutation conditions to the dictionary of drugs
             Also includes score ranges associated with the drug, (which is most often the default globalrange)
 
+            Each drug's conditions are also flattened once into self.drug_conditions,
+            keyed by drug name only, for use by score_alg.score_single
+
             @param root: algorithm root
+            Drugs are keyed by name only; self.drug_aliases maps each drug's full name to its name
+
             @return self.drugs: populated dictionary of drugs, associated with their (global) score ranges
         """
         self.drugs = {}
+        self.drug_aliases = {}  # maps drug full names to drug names
+        self.drug_conditions = {}
 
-        for element in root.getchildren():
+        for element in root:
             if element.tag == 'DRUG':
                 drug = element.find('NAME').text                            # drug name
                 fullname = element.find('FULLNAME').text                    # drug full name
+                self.drug_aliases[fullname] = drug
                 condition = element.find('RULE').find('CONDITION').text     # drug conditions
                 cond_dict = self.parse_condition(condition)                 # dictionary of parsed drug conditions
+                self.drug_conditions[drug] = self.flatten_conditions(cond_dict)
 
                 scorerange = list(element.find('RULE').find('ACTIONS').find('SCORERANGE'))[0]
                 if scorerange.find('USE_GLOBALRANGE') is None:
-                    self.drugs[drug] = self.drugs[fullname] = (cond_dict, self.definitions['globalrange'])    #default
+                    self.drugs[drug] = (cond_dict, self.definitions['globalrange'])    #default
                 else:
                     sep_dict = {}
                     globalrange = self.parse_globalrange(sep_dict, scorerange)
-                    self.drugs[drug] = self.drugs[fullname] = (cond_dict, globalrange)
+                    self.drugs[drug] = (cond_dict, globalrange)
 
         return self.drugs
 
 
+    def flatten_conditions(self, drms):
+        """ flatten_conditions function separates the penalty values from the groups of
+            (residue, amino acids) tuples in each parsed condition, so that this is not
+            repeated for every scored sequence
+
+            The amino acids of each (residue, amino acids) tuple are replaced by a bitmask
+            from aa_mask, so that testing membership is a shift rather than a string scan
+
+            @param drms: list of DRM conditions returned by parse_condition
+            @return: list of (penalties, groups) tuples, one per condition; 'AND' and
+                     'single-drm' conditions have one entry, 'MAX' conditions have several
+        """
+        flattened = []
+        for condition in drms:
+            # 'MAX' or 'MAXAND' condition is a list of 'AND' or 'single-drm' conditions
+            items = condition if isinstance(condition, list) else [condition]
+            penalties = [item['value'] for item in items]
+            groups = [[(position, self.aa_mask(aas)) for position, aas in item['group']]
+                      for item in items]
+            flattened.append((penalties, groups))
+        return flattened
+
+
+    @staticmethod
+    def aa_mask(aas):
+        """ aa_mask function encodes a string of amino acids as an integer with bit ord(aa)
+            set for each amino acid, e.g., 'FY' => (1 << 70) | (1 << 89)
+            An amino acid aa is then in the string if (mask >> ord(aa)) & 1
+
+            @param aas: string of amino acids, including 'd' and 'i' for deletions and insertions
+            @return: integer bitmask
+        """
+        mask = 0
+        for aa in aas:
+            mask |= 1 << ord(aa)
+        return mask
+
+
     def parse_condition(self, condition):
         """ parse_condition function takes a given condition (one of four types)
             'MAXAND' condition: MAX ((41L AND 215ACDEILNSV) => 5, (41L AND 215FY) => 15)
@@ -238,46 +357,32 @@ class HIVdb():
         for drm in mutation_list:
             if drm.strip().startswith('MAX'):
                 max_lib = []
-                max_chunks = re.findall('(\(?\d+[A-z]+[\s?AND\s?\d+\w]+\)?\s?=>\s?\d+|\(?\d+[A-z]+[\s?AND\s?\d+\w]+\)?\s?=>\s?-\d+)', drm)
-                iter = 0
-                for chunk in max_chunks:
+                for chunk in _MAX_CHUNK_RE.findall(drm):
                     # for both MAX conditions, need to create a mini-library that will keep all of the individual DRMs together
-                    self._parse_scores(max_lib, drm, chunk, iter)
-                    iter += 1               # iter is created to keep track of which DRM associated with which index in the list of scores in _parse_scores function
+                    self._parse_scores(max_lib, chunk)
                 self.drms.append(max_lib)   # finally append this mini-library to the DRMs library
 
             else:
-                iter = 0
-                self._parse_scores(self.drms, drm, drm, iter)
+                self._parse_scores(self.drms, drm)
 
         return self.drms
 
-                                                                                                                    #TODO: combine drm and iter so less params
-    def _parse_scores(self, drm_lib, drm, chunk, iter):
+
+    def _parse_scores(self, drm_lib, chunk):
         """ _parse_scores function is a helper function to parse_condition.
-            Parses the residues, amino acids, and scores associated with a particular DRM,
-            then updates the specified list library
+            Parses the residues, amino acids, and score associated with a particular DRM
+            in a single pass over the chunk, then updates the specified list library
 
             @param drm_lib: given library to be updated with DRMs
-            @param drm: full name of original drug resistant mutation
-            @param chunk: drm_group of one of the condition types   (kinda vague...will fix)
-            @param iter: index to keep track of which DRM is associated with respective index in the extracted list of scores
+            @param chunk: drm_group of one of the condition types, e.g. '(41L AND 215FY) => 15'
         """
-        scores = re.findall('([0-9]+(?=\W)|-[0-9]+(?=\W))', drm.strip())   # extract scores in same order as grouped drm tuples; stored in (indexable) list
-        rANDr = re.findall('\d+[A-z]+[\s?AND\s?\d+\w]+', chunk)
-
-        for combo_group in rANDr:
-            mut_list = []
-            residueAA = re.findall('[0-9]+[A-z]+', combo_group.strip())  # TODO: needs testing
-            for mutation in residueAA:
-                residue = int(re.findall('[\d]+(?!\d)(?=\w)', mutation)[0])
-                aa = str(re.findall('[0-9]+([A-z]+)', mutation)[0])
-                mut_list.append(tuple((residue, aa)))
+        mut_list = [(int(m.group(1)), m.group(2)) for m in _GROUP_RE.finditer(chunk)]
+        if not mut_list:
+            return  # no DRM on this line
 
-            # populate the drms library with the new drm condition
-            drm_lib.append({'group': mut_list, 'value': int(scores[iter])})
-            # wipe out scores stored in variable scores for next batch
-            scores[:] = []
+        # populate the drms library with the new drm condition
+        score = _SCORE_RE.search(chunk)
+        drm_lib.append({'group': mut_list, 'value': int(score.group(1))})
 
 
     def parse_comments(self, root):
@@ -289,10 +394,10 @@ class HIVdb():
         """
         self.comments = {}
 
-        for element in root.getchildren():
+        for element in root:
             if element.tag == 'MUTATION_COMMENTS':
 
-                for gene in element.getchildren():
+                for gene in element:
                     name = gene.find('NAME').text
                     gene_dict = {}
 
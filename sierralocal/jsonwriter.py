@@ -1,10 +1,17 @@
 import json
-import xml.etree.ElementTree as xml
 import re
 from sierralocal.hivdb import HIVdb
 import csv
 from pathlib import Path
-import sys, os
+import sys
+
+# package data directory, located once at import
+_DATA_DIR = Path(__file__).parent/'data'
+
+# regular expressions for parsing mutation strings, compiled once at import
+_POS_RE = re.compile(u'([0-9]+)')
+_AA_RE = re.compile(u'(?<=[0-9])([A-Za-z])+')
+_TRUNC_MUT_RE = re.compile(r'\d+\D')
 
 class JSONWriter():
     def __init__(self, algorithm):
@@ -13,29 +20,30 @@ class JSONWriter():
 
         # Set up algorithm data
         self.algorithm = algorithm
-        self.algorithm.root = xml.parse(str(self.algorithm.xml_filename)).getroot()
-        self.algorithm.version = self.algorithm.root.find('ALGVERSION').text
-        self.algorithm.version_date = self.algorithm.root.find('ALGDATE').text
-        self.definitions = self.algorithm.parse_definitions(self.algorithm.root)
+        self.definitions = self.algorithm.definitions
         self.levels = self.definitions['level']
         self.globalrange = self.definitions['globalrange']
-        self.database = self.algorithm.parse_drugs(self.algorithm.root)
-        self.comments = self.algorithm.parse_comments(self.algorithm.root)
+        self.database = self.algorithm.drugs
+        self.comments = self.algorithm.comments
 
         # Load comments files stored locally. These are distributed in the repo for now.
         dest = algorithm.json_filename
         with open(dest,'r') as csvfile:
             self.ApobecDRMs = json.load(csvfile)
+        # map (gene, position) to the APOBEC amino acids of the first matching DRM record
+        self.apobec_map = {}
+        for row in self.ApobecDRMs:
+            self.apobec_map.setdefault((row['gene'], str(row['position'])), row['aa'])
 
-        dest = str(Path(os.path.dirname(__file__))/'data'/'INSTI-comments.csv')
+        dest = str(_DATA_DIR/'INSTI-comments.csv')
         with open(dest, 'r') as INSTI_file:
             self.INSTI_comments = dict(csv.reader(INSTI_file, delimiter='\t'))
 
-        dest = str(Path(os.path.dirname(__file__))/'data'/'PI-comments.csv')
+        dest = str(_DATA_DIR/'PI-comments.csv')
         with open(dest, 'r') as PI_file:
             self.PI_comments = dict(csv.reader(PI_file, delimiter='\t'))
 
-        dest = str(Path(os.path.dirname(__file__))/'data'/'RT-comments.csv')
+        dest = str(_DATA_DIR/'RT-comments.csv')
         with open(dest, 'r') as RT_file:
             self.RT_comments = dict(csv.reader(RT_file, delimiter='\t'))
 
@@ -97,9 +105,8 @@ class JSONWriter():
                         for combination in scores[drug][2][index]:
                             # find the mutation classification "type" based on the gene
                             type_ = drugclass
-                            pos = re.findall(u'([0-9]+)',combination)[0]
-                            muts = re.findall(u'(?<=[0-9])([A-Za-z])+',combination)[0]
-                            #print(pos, muts)
+                            pos = _POS_RE.search(combination).group(1)
+                            muts = _AA_RE.search(combination).group(1)
                             if gene == 'IN':
                                 for key in self.INSTI_comments:
                                     if pos in key and muts in key:
@@ -246,9 +253,9 @@ class JSONWriter():
         return validation_results
 
     def findComment(self, gene, mutation, comments, details):
-        trunc_mut = re.findall(r'\d+\D',mutation)[0] #163K
-        pos = re.findall(u'([0-9]+)',trunc_mut)[0]
-        muts = re.findall(u'(?<=[0-9])([A-Za-z])+',trunc_mut)[0]
+        trunc_mut = _TRUNC_MUT_RE.search(mutation).group() #163K
+        pos = _POS_RE.search(trunc_mut).group(1)
+        muts = _AA_RE.search(trunc_mut).group(1)
         for g, mutationdict in comments.items():
             for item in mutationdict.keys():
                 if pos in item and muts in item:
@@ -257,11 +264,10 @@ class JSONWriter():
                         return details[full_mut]['1']
 
     def isApobecDRM(self, gene, consensus, position, AA):
-        ls = [[row['gene'], str(row['position'])] for row in self.ApobecDRMs]
-        if [gene, str(position)] in ls:
-            i = ls.index([gene, str(position)])
+        apobec_aas = self.apobec_map.get((gene, str(position)))
+        if apobec_aas is not None:
             for aa in AA:
-                if aa in self.ApobecDRMs[i]['aa']:
+                if aa in apobec_aas:
                     return True
         return False
 
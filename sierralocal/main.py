@@ -2,10 +2,31 @@ from sierralocal import score_alg
 from sierralocal.hivdb import HIVdb
 import os
 import argparse
-from sierralocal.nucaminohook import NucAminoAligner
+from sierralocal.nucaminohook import NucAminoAligner, find_nucamino_binary, start_nucamino
 from sierralocal.jsonwriter import JSONWriter
 import time
 import sys
+from multiprocessing import Pool
+
+# algorithm and aligner used by worker processes, set by _init_worker()
+_worker_algorithm = None
+_worker_aligner = None
+
+
+def _init_worker(algorithm, aligner=None):
+    global _worker_algorithm, _worker_aligner
+    _worker_algorithm = algorithm
+    _worker_aligner = aligner
+
+
+def _score_profile(profile):
+    gene, mutations = profile
+    return score_alg.score_drugs(_worker_algorithm, gene, mutations)
+
+
+def _record_mutations(args):
+    record, do_subtype = args
+    return _worker_aligner.get_record_mutations(record, do_subtype)
 
 
 def score(filename, xml_path=None, tsv_path=None, forceupdate=False, do_subtype=False):
@@ -36,24 +57,64 @@ def score(filename, xml_path=None, tsv_path=None, forceupdate=False, do_subtype=
     #os.remove(os.path.splitext(filename)[0] + '.tsv')
 
 
-def scorefile(input_file, algorithm, do_subtype=False):
+def scorefile(input_file, algorithm, do_subtype=False, aligner=None, alignment=None, pool=None,
+              chunk_size=None):
     '''
     Returns a set of corresponding names, scores, and ordered mutations for a given FASTA file containing pol sequences
     :param input_file: the FASTA file name containing arbitrary number of sequences and headers
     :param algorithm: the HIVdb drug scores and notations
+    :param aligner: <optional> NucAminoAligner to reuse across files
+    :param alignment: <optional> NucAmino process already launched by aligner.start_alignment(),
+                      if chunk_size is not set
+    :param pool: <optional> multiprocessing Pool for processing and scoring sequences, with
+                 workers initialized by _init_worker() with the algorithm and aligner
+    :param chunk_size: <optional> number of sequences per NucAmino process, to align the
+                       file in chunks with aligner.iter_alignment()
     :return: list of names, list of scores, list of ordered mutations
     '''
-    aligner = NucAminoAligner(algorithm)
-    result = aligner.align_file(input_file)
-
+    if aligner is None:
+        aligner = NucAminoAligner(algorithm)
+    if chunk_size is None:
+        alignments = [aligner.align_file(input_file, alignment)]
+    else:
+        alignments = aligner.iter_alignment(input_file, chunk_size)
+
+    sequence_headers, file_genes, file_mutations, file_trims, subtypes = [], [], [], [], []
+    for records in alignments:
+        # records are processed independently, so these can be spread over the pool
+        if pool is not None:
+            rows = pool.map(_record_mutations, [(record, do_subtype) for record in records],
+                            chunksize=32)
+        else:
+            rows = aligner.iter_mutations(records, do_subtype)
+
+        for header, genes, mutations, trims, subtype in rows:
+            sequence_headers.append(header)
+            file_genes.append(genes)
+            file_mutations.append(mutations)
+            file_trims.append(trims)
+            subtypes.append(subtype)
     print('Aligned '+input_file)
-    sequence_headers, file_genes, file_mutations, file_trims, subtypes = \
-        aligner.get_mutations(result, do_subtype=do_subtype)
 
     ordered_mutation_list = []
     sequence_scores = []
     sequence_lengths = []
 
+    # score each distinct gene and mutation profile once, since identical profiles
+    # (e.g., wild-type) recur across the sequences of a file
+    profiles = {}
+    for genes, mutations in zip(file_genes, file_mutations):
+        for gene_info, gene_muts in zip(genes, mutations):
+            gene = gene_info[0]
+            profiles.setdefault((gene, frozenset(gene_muts.items())), (gene, gene_muts))
+
+    if pool is not None:
+        profile_scores = pool.map(_score_profile, profiles.values(), chunksize=32)
+    else:
+        profile_scores = [score_alg.score_drugs(algorithm, gene, gene_muts)
+                          for gene, gene_muts in profiles.values()]
+    score_cache = dict(zip(profiles.keys(), profile_scores))
+
     # iteration over records in file
     for index, query in enumerate(sequence_headers):
         genes = file_genes[index]
@@ -77,7 +138,7 @@ def scorefile(input_file, algorithm, do_subtype=False):
                     [x[0] for x in mutations[idx].values()]   # wt
                 ))
             )
-            scores.append(score_alg.score_drugs(algorithm, gene, mutations[idx]))
+            scores.append(score_cache[(gene, frozenset(mutations[idx].items()))])
 
         ordered_mutation_list.append(mutation_lists)
         sequence_scores.append(scores)
@@ -87,7 +148,8 @@ def scorefile(input_file, algorithm, do_subtype=False):
            sequence_lengths, file_trims, subtypes
 
 
-def sierralocal(fasta, outfile, xml=None, json=None, cleanup=False, forceupdate=False):
+def sierralocal(fasta, outfile, xml=None, json=None, cleanup=False, forceupdate=False, processes=1,
+                chunk_size=None):
     """
     Contains all initializing and processing calls.
 
@@ -98,44 +160,74 @@ def sierralocal(fasta, outfile, xml=None, json=None, cleanup=False, forceupdate=
     :param tsv: <optional> path to local copy of HIVdb algorithm APOBEC DRM file
     :param skipalign:  <optional> to save time, skip NucAmino alignment step (reuse TSV output)
     :param forceupdate:  <optional> forces sierralocal to update its local copy of the HIVdb algorithm
+    :param processes:  <optional> number of processes for processing and scoring sequences
+    :param chunk_size:  <optional> number of sequences per NucAmino process, to align each
+                        file in chunks while the previous chunk is processed
 
     :return:  a tuple of (number of records processed, time elapsed initializing algorithm)
     """
 
-    # initialize algorithm and jsonwriter
-    time0 = time.time()
-    algorithm = HIVdb(asi2=xml, apobec=json, forceupdate=forceupdate)
-    writer = JSONWriter(algorithm)
-    time_elapsed = time.time() - time0
-
     # accommodate single file path argument
     if type(fasta) is str:
         fasta = [fasta]
 
-    # begin processing
-    count = 0
-    for input_file in fasta:
-        prefix = os.path.splitext(input_file)[0]
-
-        # process and score file
-        sequence_headers, sequence_scores, ordered_mutation_list, file_genes, sequence_lengths, \
-        file_trims, subtypes = scorefile(input_file, algorithm)
+    # align the first file in advance, unless files are aligned in chunks, so that
+    # NucAmino runs while the algorithm is loaded
+    binary = find_nucamino_binary()
+    alignment = None
+    if fasta and chunk_size is None:
+        alignment = start_nucamino(binary, fasta[0])
 
-        count += len(sequence_headers)
-        print("{} sequences found in file {}.".format(len(sequence_headers), input_file))
+    # initialize algorithm, aligner and jsonwriter
+    # time_elapsed covers XML processing only, not building the aligner or waiting
+    # on NucAmino
+    time0 = time.time()
+    algorithm = HIVdb(asi2=xml, apobec=json, forceupdate=forceupdate)
+    writer = JSONWriter(algorithm)
+    time_elapsed = time.time() - time0
 
-        # output results for the file
-        if outfile == None:
-            output_file = prefix+'_results.json'
-        else:
-            output_file = outfile
+    aligner = NucAminoAligner(algorithm, binary=binary)
 
-        writer.write_to_json(output_file, sequence_headers, sequence_scores, file_genes, ordered_mutation_list,
-                             sequence_lengths, file_trims, subtypes)
+    # workers are started once and reused for every file
+    pool = None
+    if processes > 1:
+        pool = Pool(processes, initializer=_init_worker, initargs=(algorithm, aligner))
 
-        if cleanup:
-            # delete alignment file
-            os.remove(prefix+'.tsv')
+    # begin processing
+    count = 0
+    try:
+        for index, input_file in enumerate(fasta):
+            prefix = os.path.splitext(input_file)[0]
+
+            # process and score file
+            sequence_headers, sequence_scores, ordered_mutation_list, file_genes, sequence_lengths, \
+            file_trims, subtypes = scorefile(input_file, algorithm, aligner=aligner, alignment=alignment,
+                                             pool=pool, chunk_size=chunk_size)
+
+            # align the next file while results for this one are written
+            if index + 1 < len(fasta) and chunk_size is None:
+                alignment = aligner.start_alignment(fasta[index + 1])
+
+            count += len(sequence_headers)
+            print("{} sequences found in file {}.".format(len(sequence_headers), input_file))
+
+            # output results for the file
+            if outfile == None:
+                output_file = prefix+'_results.json'
+            else:
+                output_file = outfile
+
+            writer.write_to_json(output_file, sequence_headers, sequence_scores, file_genes, ordered_mutation_list,
+                                 sequence_lengths, file_trims, subtypes)
+
+            if cleanup:
+                # delete alignment file
+                os.remove(prefix+'.tsv')
+    finally:
+        # shut down the workers even if a file fails to align, score or write
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     return count, time_elapsed
 
@@ -158,7 +250,13 @@ def parse_args():
                         help='Deletes NucAmino alignment file after processing.')
     parser.add_argument('--forceupdate', action='store_true',
                         help='Forces update of HIVdb algorithm. Requires network connection.')
+    parser.add_argument('-p', dest='processes', default=1, type=int,
+                        help='<optional> Number of processes for processing and scoring sequences (only worthwhile for very large inputs).')
+    parser.add_argument('-c', dest='chunk_size', default=None, type=int,
+                        help='<optional> Number of sequences per NucAmino process, to align large inputs in chunks.')
     args = parser.parse_args()
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error('-c must be at least 1')
     return args
 
 
@@ -176,7 +274,8 @@ def main():
 
     time_start = time.time()
     count, time_elapsed = sierralocal(args.fasta, args.outfile, xml=args.xml, json=args.json,
-                                      cleanup=args.cleanup, forceupdate=args.forceupdate)
+                                      cleanup=args.cleanup, forceupdate=args.forceupdate,
+                                      processes=args.processes, chunk_size=args.chunk_size)
     time_diff = time.time() - time_start
 
     print("Time elapsed: {:{prec}} seconds ({:{prec}} it/s)".format(
@@ -1,5 +1,8 @@
 import subprocess
 import os
+import bisect
+from collections import namedtuple
+from itertools import compress, product, repeat
 from pathlib import Path
 import csv
 import re
@@ -9,46 +12,158 @@ import sys
 import platform
 from csv import DictReader
 import json
-import codecs
 import tempfile
 
+# package directories, located once at import
+_BIN_DIR = Path(__file__).parent/'bin'
+_DATA_DIR = Path(__file__).parent/'data'
+
+# characters that NucAmino rejects in sequences, deleted in a single pass
+_ILLEGAL_CHARS = str.maketrans('', '', '~-.')
+
+
+def _trim_scan(badSites, window, cutoff):
+    """
+    Scan for trimming one end of a sequence, for NucAminoAligner.trimLowQualities().
+    The scan stops at the first run of more than window valid sites, and trims up to the
+    last invalid site at which more than cutoff percent of the sites scanned are invalid.
+
+    @param badSites: sorted positions of invalid sites, counted from the end being trimmed
+    @param window: longest run of valid sites to scan past
+    @param cutoff: percentage of invalid sites at which to trim
+    @return: number of sites to trim from this end
+    """
+    trim = 0
+    problemSites = 0
+    lastBadQuality = -1
+    for idx in badSites:
+        sinceLastBadQuality = idx - lastBadQuality - 1
+        if sinceLastBadQuality > window:
+            break
+        problemSites += 1
+        badPcnt = problemSites * 100 / (idx + 1)
+        if badPcnt > cutoff:
+            trim = idx + 1
+        lastBadQuality = idx
+    return trim
+
+
+def find_nucamino_binary():
+    """
+    Locate the NucAmino binary bundled for this platform.  This does not depend on the
+    algorithm, so the first alignment can be launched (with start_nucamino()) before the
+    HIVdb algorithm is loaded.
+
+    @return:  Path to the nucamino binary
+    """
+    target = 'nucamino-{}-{}'.format(
+        platform.system().lower(),
+        'amd64' if platform.architecture()[0]=='64bit' else '386'
+    )
+
+    # autodetect nucamino binary
+    for path in _BIN_DIR.iterdir():
+        if path.stem == target:
+            print("Found NucAmino binary", path)
+            return path
+
+    sys.exit('Failed to locate expected NucAmino binary {}. '.format(target) +
+             'Please download binary from ' +
+             'http://github.com/hivdb/nucamino/releases')
+
+
+def start_nucamino(binary, filename, lines=None):
+    """
+    Launch NucAmino on a FASTA file without waiting for it to finish, so that other
+    work (e.g., parsing the HIVdb algorithm) can proceed while the alignment runs.
+    The FASTA file is streamed to NucAmino's stdin as it is read, rather than copied
+    to a temporary file for NucAmino to read again.  NucAmino writes its JSON output
+    to a temporary file rather than to a pipe, so it never blocks on a full stdout buffer.
+
+    @param binary:  Path to nucamino binary, e.g., from find_nucamino_binary()
+    @param filename:  Path to FASTA file to process
+    @param lines:  <optional> FASTA lines to align instead of the whole file, e.g., one
+                   chunk of the file from NucAminoAligner.iter_alignment()
+    @return:  tuple of (NucAmino process, output temporary file) to pass to
+              NucAminoAligner.align_file()
+    """
+
+    #TODO: check that file is FASTA format
+
+    outfile = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    outfile.close()
+
+    args = [
+        '{}'.format(binary),  # in case of byte-string
+        "align",
+        "hiv1b",
+        "pol",
+        "-q",
+        "-i", "-",
+        "-o", outfile.name,
+        '--output-format', 'json',
+    ]
+    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                         universal_newlines=True)
+
+    try:
+        if lines is None:
+            with open(filename) as handle:
+                p.stdin.writelines(_clean_fasta_lines(handle))
+        else:
+            p.stdin.writelines(_clean_fasta_lines(lines))
+        p.stdin.close()
+    except BrokenPipeError:
+        pass  # NucAmino exited early, align_file() reports its exit status
+    return p, outfile.name
+
+
+# genes, trimmed mutations and subtype of one aligned sequence
+RecordMutations = namedtuple('RecordMutations', ['header', 'genes', 'mutations', 'trims', 'subtype'])
+
+
+def _clean_fasta_lines(lines):
+    # remove illegal characters from sequence lines
+    for line in lines:
+        yield line if line.startswith('>') else line.translate(_ILLEGAL_CHARS)
+
+
+def _fasta_chunks(lines, chunk_size):
+    # group FASTA lines into lists holding up to chunk_size records each
+    chunk = []
+    count = 0
+    for line in lines:
+        if line.startswith('>'):
+            if count == chunk_size:
+                yield chunk
+                chunk = []
+                count = 0
+            count += 1
+        chunk.append(line)
+    if chunk:
+        yield chunk
+
 
 class NucAminoAligner():
     """
     Initialize NucAmino for a specific input fasta file
     """
+    _tripletTable = None  # shared by all instances, set by generateTable()
+    _prevalences = {}  # shared by all instances, filename -> table set by prevalence_parser()
+    # whether each triplet of nucleotide codes and gaps is unsequenced, for isUnsequenced()
+    unsequencedTable = {
+        ''.join(triplet): triplet.count('N') + triplet.count('-') > 1
+        for triplet in product('ACGTRYMWSKBDHVN-', repeat=3)
+    }
+
     def __init__(self, algorithm, binary=None):
         """
 
         :param binary:  Absolute path to nucamino binary
         """
         self.cwd = os.path.curdir
-        self.reader = codecs.getreader('utf-8')  # for parsing byte strings from json in align_file()
-
-        if binary is None:
-            target = 'nucamino-{}-{}'.format(
-                platform.system().lower(),
-                'amd64' if platform.architecture()[0]=='64bit' else '386'
-            )
 
-            # autodetect nucamino binary
-            bin_dir = Path(os.path.dirname(__file__)).joinpath('bin')
-            items = os.listdir(str(bin_dir))
-            self.nucamino_binary = None
-            for name in items:
-                fn = os.path.splitext(name)[0]
-                if fn == target:
-                    self.nucamino_binary = bin_dir.joinpath(name)
-                    break
-
-            if self.nucamino_binary is None:
-                sys.exit('Failed to locate expected NucAmino binary {}. '.format(target) +
-                         'Please download binary from ' +
-                         'http://github.com/hivdb/nucamino/releases')
-
-            print("Found NucAmino binary", self.nucamino_binary)
-        else:
-            self.nucamino_binary = binary
+        self.nucamino_binary = find_nucamino_binary() if binary is None else binary
 
         self.tripletTable = self.generateTable()
 
@@ -56,10 +171,16 @@ class NucAminoAligner():
         with open(algorithm.json_filename) as jsonfile:
             # self.ApobecDRMs = list(csv.reader(csvfile, delimiter='\t'))
             self.ApobecDRMs = json.load(jsonfile)
+        # map (gene, position) to the APOBEC amino acids of the first matching DRM record,
+        # so that isApobecDRM is a dict lookup rather than a scan of every record
+        self.apobec_map = {}
+        for row in self.ApobecDRMs:
+            self.apobec_map.setdefault((row['gene'], str(row['position'])), row['aa'])
 
         self.PI_dict = self.prevalence_parser('PIPrevalences.tsv')
         self.RTI_dict = self.prevalence_parser('RTIPrevalences.tsv')
         self.INI_dict = self.prevalence_parser('INIPrevalences.tsv')
+        self.prev_by_gene = {'PR': self.PI_dict, 'RT': self.RTI_dict, 'IN': self.INI_dict}
 
         #initialize gene map
         self.pol_start = 2085
@@ -78,27 +199,31 @@ class NucAminoAligner():
         Abstracted method for reading ARV prevalence TSV and returning a dictionary of these data.
         There are two entries for each subtype for treatment-naive and -experienced populations,
         respectively, e.g., B:RTI_Naive:% and B:RTI:%
-        We take the larger of the two.
+        Where both are present, the value in the later column of the file is kept.
 
         :param filename:  Name of TSV file to parse
         :return:  Dictionary of position-consensus-mutation-subtype keys to %prevalence in naive
                   populations
         '''
-        handle = open(str(Path(os.path.dirname(__file__))/'data'/filename), 'r')
-        table = csv.DictReader(handle, delimiter='\t')
-
-        keys = [fn for fn in table.fieldnames if fn.endswith(':%')]
-        result = {}
-        for row in table:
-            for key in keys:
-                value = float(row[key])
-                subtype = key.split(':')[0]
-                label = row['Pos'] + row['Cons'] + row['Mut'] + subtype
-                if label in result and result[label] < value:
-                    # take the greater percentage of naive or experienced groups
-                    result[label] = value
-                else:
-                    result.update({label: value})
+        if filename in NucAminoAligner._prevalences:
+            # the packaged tables do not change, so each is parsed once per process
+            return NucAminoAligner._prevalences[filename]
+
+        with open(str(_DATA_DIR/filename), 'r') as handle:
+            table = csv.reader(handle, delimiter='\t')
+            header = next(table)
+            pos_i, cons_i, mut_i = header.index('Pos'), header.index('Cons'), header.index('Mut')
+            # column index and subtype of each prevalence field, found once from the header
+            columns = [(i, fn.split(':')[0]) for i, fn in enumerate(header) if fn.endswith(':%')]
+
+            result = {}
+            for row in table:
+                pcm = row[pos_i] + row[cons_i] + row[mut_i]
+                for i, subtype in columns:
+                    # the later of the naive and experienced columns for a subtype wins
+                    result[pcm + subtype] = float(row[i])
+
+        NucAminoAligner._prevalences[filename] = result
         return result
 
 
@@ -113,7 +238,7 @@ class NucAminoAligner():
 
         # FIXME: this isn't handling insertions and deletions properly
         # FIXME: the NucAmino coordinate system does not adapt to indels
-        aligned = ''
+        aligned = []  # codons, joined once at the end
         skip = 0
         pad = 0  # used to accommodate deletions upstream of PR start codon
         for si, site in enumerate(sites):
@@ -133,21 +258,61 @@ class NucAminoAligner():
                 continue
 
             if lengthNA == 3:
-                aligned += codon
+                aligned.append(codon)
             elif lengthNA < 3:
                 # deletion
-                aligned += codon.replace(' ', '-')
+                aligned.append(codon.replace(' ', '-'))
             else:
                 # insertion
                 skip = (lengthNA - 3) / 3
-                aligned += codon
+                aligned.append(codon)
+
+        return ''.join(aligned)
+
+
+    def start_alignment(self, filename, lines=None):
+        """
+        Launch NucAmino on a FASTA file without waiting for it to finish, as
+        start_nucamino() with this aligner's binary.
+
+        @param filename:  Path to FASTA file to process
+        @param lines:  <optional> FASTA lines to align instead of the whole file, e.g., one
+                       chunk of the file from iter_alignment()
+        @return:  tuple of (NucAmino process, output temporary file) to pass to align_file()
+        """
+        return start_nucamino(self.nucamino_binary, filename, lines)
+
 
-        return aligned
+    def iter_alignment(self, filename, chunk_size):
+        """
+        Align a FASTA file with one NucAmino process per chunk of chunk_size sequences.
+        Each chunk is launched before the records of the previous chunk are yielded, so
+        that alignment overlaps with the processing of those records, and the NucAmino
+        output is parsed and held in memory one chunk at a time.
 
+        @param filename:  Path to FASTA file to process
+        @param chunk_size:  number of sequences per chunk
+        @return:  generator of lists of records, as returned by align_file(), in file order
+        """
+        if chunk_size < 1:
+            # a chunk of no sequences would run NucAmino on empty input
+            raise ValueError('chunk_size must be at least 1, not {}'.format(chunk_size))
+
+        alignment = None
+        with open(filename) as handle:
+            for chunk in _fasta_chunks(handle, chunk_size):
+                next_alignment = self.start_alignment(filename, chunk)
+                if alignment is not None:
+                    yield self.align_file(filename, alignment)
+                alignment = next_alignment
 
-    def align_file(self, filename):
+        if alignment is not None:
+            yield self.align_file(filename, alignment)
+
+
+    def align_file(self, filename, alignment=None):
         '''
-        Using subprocess to call NucAmino, generates an output .tsv containing mutation
+        Using subprocess to call NucAmino, generates JSON output containing mutation
         data for each sequence in the FASTA file.
         Reconstitute aligned codon sequence from NucAmino output.
         For each codon in NucleicAcidsLine:
@@ -155,31 +320,22 @@ class NucAminoAligner():
         - if LengthNA == 3+n where n>0, the following n bases are insertions to be removed
 
         @param filename:  Path to FASTA file to process
+        @param alignment:  <optional> result of start_alignment() for this file, if
+                           NucAmino has already been launched
         '''
+        if alignment is None:
+            alignment = self.start_alignment(filename)
+        p, outfile = alignment
 
-        #TODO: check that file is FASTA format
+        returncode = p.wait()
+        if returncode != 0:
+            os.remove(outfile)
+            sys.exit('NucAmino failed to align {} (exit status {})'.format(filename, returncode))
+
+        with open(outfile, encoding='utf-8') as handle:
+            result = json.load(handle)
+        os.remove(outfile)
 
-        # remove illegal characters
-        tf = tempfile.NamedTemporaryFile(mode='w', delete=False)
-        with open(filename) as handle:
-            for line in handle:
-                if not line.startswith('>'):
-                    line = line.replace('~', '').replace('-', '').replace('.', '')
-                tf.write(line)
-        tf.close()
-
-        args = [
-            '{}'.format(self.nucamino_binary),  # in case of byte-string
-            "align",
-            "hiv1b",
-            "pol",
-            "-q",
-            "-i", tf.name,
-            '--output-format', 'json',
-        ]
-        p = subprocess.Popen(args, stdout=subprocess.PIPE)  #, encoding='utf8')
-
-        result = json.load(self.reader(p.stdout))
         records = []
 
         for record in result['POL']:
@@ -209,15 +365,34 @@ class NucAminoAligner():
         """
         Returns a dictionary with the AMINO ACID position bounds for each gene in Pol,
         based on the HXB2 reference annotations.
+        The bounds are also stored sorted by start position, for get_gene().
         """
         # start and end nucleotide coordinates in HXB2 pol
         convert = lambda x: int((x-self.pol_start)/3)
         pol_aa_map = {}
         for key, val in self.pol_nuc_map.items():
             pol_aa_map[key] = (convert(val[0]), convert(val[1]))
+
+        bounds = sorted((start, end, gene) for gene, (start, end) in pol_aa_map.items())
+        self._gene_starts = [start for start, end, gene in bounds]
+        self._gene_ends = [end for start, end, gene in bounds]
+        self._gene_names = [gene for start, end, gene in bounds]
         return pol_aa_map
 
 
+    def get_gene(self, position):
+        """
+        Finds the gene containing an amino acid position in Pol, by bisecting the gene
+        bounds sorted by create_gene_map().
+        @param position: amino acid position relative to the start of pol
+        @return: name of the gene, or None if the position is outside every gene
+        """
+        i = bisect.bisect_right(self._gene_starts, position) - 1
+        if i >= 0 and position <= self._gene_ends[i]:
+            return self._gene_names[i]
+        return None
+
+
     def get_genes(self, polAlignedSites, polFirstAA, polLastAA):
         """
         Determines the first POL gene that is present in the query sequence, by virtue of gene breakpoints
@@ -235,13 +410,15 @@ class NucAminoAligner():
                 # discard alignment of this gene, too short
                 continue
 
-            alignedSites = filter(lambda x: x['PosAA'] >= aaStart and x['PosAA'] <= aaEnd, polAlignedSites)
-            alignedSites = list(alignedSites)
+            # only the first and last aligned sites within this gene are needed, so scan
+            # inwards from either end instead of filtering every site of the record
+            firstSite = next(s for s in polAlignedSites if aaStart <= s['PosAA'] <= aaEnd)
+            lastSite = next(s for s in reversed(polAlignedSites) if aaStart <= s['PosAA'] <= aaEnd)
 
             firstAA = max(polFirstAA-aaStart, 1)
             lastAA = min(polLastAA-aaStart+1, geneLength)
-            firstNA = alignedSites[0]['PosNA']
-            lastNA = alignedSites[-1]['PosNA'] - 1 + alignedSites[-1]['LengthNA']
+            firstNA = firstSite['PosNA']
+            lastNA = lastSite['PosNA'] - 1 + lastSite['LengthNA']
 
             genes.append((gene, firstAA, lastAA, firstNA, lastNA))
 
@@ -251,6 +428,7 @@ class NucAminoAligner():
     def get_mutations(self, records, do_subtype=False):
         '''
         From the tsv output of NucAmino, parses and adjusts indices and returns as lists.
+        See iter_mutations() to process one record at a time.
 
         TSV has mutations format I59V:GTC,N93S:AGT
 
@@ -271,59 +449,11 @@ class NucAminoAligner():
         sequence_headers = []
         subtypes = []
 
-        for record in records:
-            sequence_headers.append(record['Name'])
-
-            polFirstAA = record['FirstAA']
-            polLastAA = record['LastAA']
-
-            # predict subtype
-            subtype = ''
-            if do_subtype:
-                offset = (polFirstAA-57)*3
-                if offset < 0:
-                    offset = 0  # align_file() will have trimmed sequence preceding PR
-                subtype = self.typer.getClosestSubtype(record['Sequence'], offset)
-
-            genes = self.get_genes(record['AlignedSites'], polFirstAA, polLastAA)
-
-            trimmed_gene_muts = []
-            trims = []
-            first_lastNAs = []
-            just_genes = []
-
-            for gene, firstAA, lastAA, firstNA, lastNA in genes:
-                just_genes.append(gene)
-                first_lastNAs.append((firstNA, lastNA))
-
-                # {'PR': (56, 154), 'RT': (155, 714), 'IN': (715, 1003)}
-                left, right = self.gene_map[gene]
-                codon_list = []
-                gene_muts = {}
-                for mut in record['Mutations']:
-                    position = mut['Position']
-                    if position < left or right < position:
-                        continue  # mutation in other gene
-                    codon = mut['CodonText']
-                    gene_muts.update(
-                        {position-left: (mut['ReferenceText'], self.translateNATriplet(codon))}
-                    )
-                    codon_list.append(codon)
-
-                # trim low quality leading and trailing nucleotides
-                trimLeft, trimRight = self.trimLowQualities(
-                    codon_list, left, firstAA, lastAA, mutations=gene_muts,
-                    frameshifts=[], gene=gene, subtype=subtype
-                )
-                trims.append( (trimLeft, trimRight) )
-                trimmed_gene_muts.append(
-                    {k: v for k, v in gene_muts.items() if
-                     (k >= firstAA + trimLeft) and
-                     (k <= lastAA - trimRight)}
-                )
+        for header, genes, gene_muts, trims, subtype in self.iter_mutations(records, do_subtype):
 
             # update lists
-            file_mutations.append(trimmed_gene_muts)
+            sequence_headers.append(header)
+            file_mutations.append(gene_muts)
             file_genes.append(genes)
             file_trims.append(trims)
             subtypes.append(subtype)
@@ -334,23 +464,106 @@ class NucAminoAligner():
         return sequence_headers, file_genes, file_mutations, file_trims, subtypes
 
 
+    def iter_mutations(self, records, do_subtype=False):
+        '''
+        Generator version of get_mutations(), which yields the result for each record as
+        it is parsed instead of collecting the results for all records into lists.
+
+        :param records:  iterable of records returned by align_file()
+        :param do_subtype:  if True, predict the subtype of each sequence
+        :return: generator of RecordMutations, one per record
+        '''
+        for record in records:
+            yield self.get_record_mutations(record, do_subtype)
+
+
+    def get_record_mutations(self, record, do_subtype=False):
+        '''
+        Parses the genes, trimmed mutations and subtype of one NucAmino record, for
+        get_mutations().  Records are independent of each other, so this may also be
+        mapped over records in worker processes.
+
+        :param record:  record returned by align_file()
+        :param do_subtype:  if True, predict the subtype of the sequence
+        :return: RecordMutations of sequence name, genes, list of gene mutation dictionaries,
+                 list of gene trims and subtype
+        '''
+        polFirstAA = record['FirstAA']
+        polLastAA = record['LastAA']
+
+        # predict subtype
+        subtype = ''
+        if do_subtype:
+            offset = (polFirstAA-57)*3
+            if offset < 0:
+                offset = 0  # align_file() will have trimmed sequence preceding PR
+            subtype = self.typer.getClosestSubtype(record['Sequence'], offset)
+
+        genes = self.get_genes(record['AlignedSites'], polFirstAA, polLastAA)
+
+        # assign each mutation to its gene once, rather than rescanning for every gene
+        gene_mutations = {}
+        for mut in record['Mutations']:
+            gene = self.get_gene(mut['Position'])
+            if gene is not None:
+                gene_mutations.setdefault(gene, []).append(mut)
+
+        trimmed_gene_muts = []
+        trims = []
+        first_lastNAs = []
+        just_genes = []
+
+        for gene, firstAA, lastAA, firstNA, lastNA in genes:
+            just_genes.append(gene)
+            first_lastNAs.append((firstNA, lastNA))
+
+            # {'PR': (56, 154), 'RT': (155, 714), 'IN': (715, 1003)}
+            left, right = self.gene_map[gene]
+            muts = gene_mutations.get(gene, [])
+            codon_list = [mut['CodonText'] for mut in muts]
+            gene_muts = {}
+            # translate all codons of the gene at once
+            for mut, aa in zip(muts, self.translateNATriplets(codon_list)):
+                position = mut['Position']
+                gene_muts[position-left] = (mut['ReferenceText'], aa)
+
+            # trim low quality leading and trailing nucleotides
+            trimLeft, trimRight = self.trimLowQualities(
+                codon_list, left, firstAA, lastAA, mutations=gene_muts,
+                frameshifts=[], gene=gene, subtype=subtype
+            )
+            trims.append( (trimLeft, trimRight) )
+            lo, hi = firstAA + trimLeft, lastAA - trimRight
+            trimmed_gene_muts.append(
+                {k: v for k, v in gene_muts.items() if lo <= k <= hi}
+            )
+
+        return RecordMutations(record['Name'], genes, trimmed_gene_muts, trims, subtype)
+
+
     # BELOW is an implementation of sierra's Java algorithm for determining codon ambiguity
 
     def translateNATriplet(self, triplet):
         """
         Translates a nucleotide triplet into its amino acid mixture or ambiguity.
+        Every valid triplet (and the empty codon) is a key of tripletTable, so anything
+        else, e.g. a partial codon or one containing '~', translates to 'X'.
         @param triplet: nucleotide sequence as a string
         @return: translation of the triplet as a string
         """
-        if len(triplet) == 0:
-            return '-'
-        if len(triplet) != 3:
-            return "X"
-        if '~' in triplet:
-            return "X"
         return self.tripletTable.get(triplet, 'X')
 
 
+    def translateNATriplets(self, triplets):
+        """
+        Translates a list of nucleotide triplets, as translateNATriplet, in one pass
+        without a method call per triplet.
+        @param triplets: list of nucleotide triplets as strings
+        @return: list of translations of the triplets as strings
+        """
+        return list(map(self.tripletTable.get, triplets, repeat('X', len(triplets))))
+
+
     def generateTable(self):
         """
         Generates a dictionary of codon to amino acid mappings, including ambiguous combinations.
@@ -374,23 +587,24 @@ class NucAminoAligner():
             "AGT": "S", "AGC": "S", "AGA": "R", "AGG": "R",
             "GGT": "G", "GGC": "G", "GGA": "G", "GGG": "G"
         }
+        if NucAminoAligner._tripletTable is not None:
+            # the table is the same for every aligner, so it is built once per process
+            return NucAminoAligner._tripletTable
+
         nas = ["A","C","G","T","R","Y","M","W","S","K","B","D","H","V","N"]
         tripletTable = dict()
-        for i in range(len(nas)):
-            for j in range(len(nas)):
-                for k in range(len(nas)):
-                    triplet = nas[i] + nas[j] + nas[k]
-                    codons = self.enumerateCodonPossibilities(triplet)
-                    uniqueAAs = []
-                    for codon in codons:
-                        c = codonToAminoAcidMap[codon]
-                        if c not in uniqueAAs:
-                            uniqueAAs.append(c)
-                    if len(uniqueAAs) > 4:
-                        aas = "X"
-                    else:
-                        aas = ''.join(uniqueAAs)
-                    tripletTable[triplet] = aas
+        for triplet in map(''.join, product(nas, repeat=3)):
+            codons = self.enumerateCodonPossibilities(triplet)
+            # distinct amino acids, in order of first occurrence
+            uniqueAAs = list(dict.fromkeys(codonToAminoAcidMap[codon] for codon in codons))
+            if len(uniqueAAs) > 4:
+                aas = "X"
+            else:
+                aas = ''.join(uniqueAAs)
+            tripletTable[triplet] = aas
+        tripletTable[''] = '-'  # empty codon
+
+        NucAminoAligner._tripletTable = tripletTable
         return tripletTable
 
 
@@ -408,12 +622,10 @@ class NucAminoAligner():
             "H": ["A","C","T"], "V": ["A","C","G"],
             "N": ["A","C","G","T"]
         }
-        codonPossibilities = []
         pos1, pos2, pos3 = triplet
-        for p1 in ambiguityMap[pos1]:
-            for p2 in ambiguityMap[pos2]:
-                for p3 in ambiguityMap[pos3]:
-                    codonPossibilities.append(p1+p2+p3)
+        codonPossibilities = list(map(''.join, product(
+            ambiguityMap[pos1], ambiguityMap[pos2], ambiguityMap[pos3]
+        )))
         return codonPossibilities
     
 
@@ -437,71 +649,35 @@ class NucAminoAligner():
         SEQUENCE_SHRINKAGE_WINDOW = 15
         SEQUENCE_SHRINKAGE_BAD_QUALITY_MUT_PREVALENCE = 0.1
 
-        #print(mutations)
-        #print(codon_list)
-
-        badPcnt = 0
-        problemSites = 0
-        sinceLastBadQuality = 0
         proteinSize = lastAA - firstAA + 1
 
-        candidates = []
-        invalidSites = [False for i in range(proteinSize)]
+        invalidSites = [False] * proteinSize
 
-        # account for invalid sites
-        for j, position in enumerate(mutations):
+        # account for invalid sites: ambiguous, stop codon, APOBEC DRM or unusual mutation,
+        # tested in order of cost so that later checks are skipped once a site is invalid
+        for j, (position, mutation) in enumerate(mutations.items()):
             idx = position - firstAA #+ shift
-            if not self.isUnsequenced(codon_list[j]):
-                highest_prev = self.getHighestMutPrevalence((position, mutations[position]), gene, subtype)
-                is_weird = (highest_prev < SEQUENCE_SHRINKAGE_BAD_QUALITY_MUT_PREVALENCE)
-                is_ambig = (mutations[position][1] == 'X')
-                is_apobec = self.isApobecDRM(gene, mutations[position][0], position,
-                                             mutations[position][1])
-                is_stop_codon = self.isStopCodon(codon_list[j])
-                reasons = [is_weird, is_ambig, is_apobec, is_stop_codon]
-                if any(reasons):
-                    #print(idx, position, reasons, highest_prev, subtype, position, mutations[position], gene)
-                    invalidSites[idx] = True
+            codon = codon_list[j]
+            if self.isUnsequenced(codon):
+                continue
+            consensus, aas = mutation
+            if (aas == 'X' or
+                    self.isStopCodon(codon) or
+                    self.isApobecDRM(gene, consensus, position, aas) or
+                    self.getHighestMutPrevalence((position, mutation), gene, subtype) <
+                    SEQUENCE_SHRINKAGE_BAD_QUALITY_MUT_PREVALENCE):
+                invalidSites[idx] = True
 
         # for fs in frameshifts:
         #     idx = fs.getPosition() - firstAA
         #     invalidSites[idx] = True
 
-        # forward scan for trimming left
-        for idx in range(0, proteinSize):
-            if sinceLastBadQuality > SEQUENCE_SHRINKAGE_WINDOW:
-                break
-
-            if invalidSites[idx]:
-                problemSites += 1
-                trimLeft = idx + 1
-                badPcnt = problemSites * 100 / trimLeft if trimLeft > 0 else 0
-                if badPcnt > SEQUENCE_SHRINKAGE_CUTOFF_PCNT:
-                    candidates.append(trimLeft)
-                sinceLastBadQuality = 0
-            else:
-                sinceLastBadQuality += 1
-
-        trimLeft = candidates[-1] if len(candidates) > 0 else 0
-        candidates = []
-
-
-        #backward scan for trimming right
-        problemSites = 0
-        sinceLastBadQuality = 0
-        for idx in range(proteinSize-1, -1, -1):
-            if sinceLastBadQuality > SEQUENCE_SHRINKAGE_WINDOW:
-                break
-            elif invalidSites[idx]:
-                problemSites += 1
-                trimRight = proteinSize - idx
-                badPcnt = problemSites * 100 / trimRight if trimRight > 0 else 0
-                if badPcnt > SEQUENCE_SHRINKAGE_CUTOFF_PCNT:
-                    candidates.append(trimRight)
-                sinceLastBadQuality = 0
-            else:
-                sinceLastBadQuality += 1
-        trimRight = candidates[-1] if len(candidates) > 0 else 0
+        # Only invalid sites change the scan state, so visit just those in either direction,
+        # with the backward scan counting positions from the end
+        badSites = list(compress(range(proteinSize), invalidSites))
+        trimLeft = _trim_scan(badSites, SEQUENCE_SHRINKAGE_WINDOW, SEQUENCE_SHRINKAGE_CUTOFF_PCNT)
+        trimRight = _trim_scan([proteinSize - 1 - idx for idx in reversed(badSites)],
+                               SEQUENCE_SHRINKAGE_WINDOW, SEQUENCE_SHRINKAGE_CUTOFF_PCNT)
 
         return (trimLeft, trimRight)
 
@@ -510,17 +686,19 @@ class NucAminoAligner():
     "NNN", "NN-", "NNG" should be considered as unsequenced region.
     """
     def isUnsequenced(self, triplet):
-        return (triplet.replace("-", "N").count("N") > 1) #TODO: incorporate !isInsertion &&
+        unsequenced = self.unsequencedTable.get(triplet)
+        if unsequenced is None:
+            unsequenced = (triplet.count("N") + triplet.count("-") > 1) #TODO: incorporate !isInsertion &&
+        return unsequenced
 
     def isStopCodon(self, triplet):
         return ("*" in self.translateNATriplet(triplet))
 
     def isApobecDRM(self, gene, consensus, position, AA):
-        ls = [[row['gene'], str(row['position'])] for row in self.ApobecDRMs]
-        if [gene, str(position)] in ls:
-            i = ls.index([gene, str(position)])
+        apobec_aas = self.apobec_map.get((gene, str(position)))
+        if apobec_aas is not None:
             for aa in AA:
-                if aa in self.ApobecDRMs[i]['aa']:
+                if aa in apobec_aas:
                     return True
         return False
 
@@ -548,19 +726,12 @@ class NucAminoAligner():
 
 
     def getMutPrevalence(self, position, cons, aa, gene, subtype):
-        key2 = str(position)+str(cons)+str(aa)+subtype
-        #print(key2)
+        gene_dict = self.prev_by_gene.get(gene)
+        if gene_dict is None:
+            return 100.0
 
-        if gene == 'IN' and key2 in self.INI_dict:
-            return self.INI_dict[key2]
-
-        if gene == 'PR' and key2 in self.PI_dict:
-            return self.PI_dict[key2]
-
-        if gene == 'RT' and key2 in self.RTI_dict:
-            return self.RTI_dict[key2]
-
-        return 100.0
+        key2 = str(position)+str(cons)+str(aa)+subtype
+        return gene_dict.get(key2, 100.0)
 
 
 if __name__ == '__main__':
@@ -11,20 +11,40 @@ def score_drugs(HIVdb, gene, seq_mutations):
         @return result_dict: a dictionary holding the score results of each drug for the given sequence
     """
     result_dict = {}
+    seq_mutations = prepare_mutations(seq_mutations)
     for drug_class in HIVdb.definitions['gene'][gene]:
         for drug in HIVdb.definitions['drugclass'][drug_class]:
             result_dict.update({drug: score_single(HIVdb, drug, seq_mutations)})
     return result_dict
 
 
+def prepare_mutations(seq_mutations):
+    """ prepare_mutations function resolves the amino acids at each mutated position of a
+        sequence into the symbols used by HIVdb conditions, once per sequence rather than
+        once per drug: deletions ('-') become 'd' and insertions ('_') become 'i'
+
+        @param seq_mutations: dictionary of <position>: (<wt>, <mutant>) pairs
+        @return: dictionary of <position>: (<wt>, <condition symbols>) pairs
+    """
+    prepared = {}
+    for position, (wt, aas) in seq_mutations.items():
+        if '_' in aas:
+            aas = 'i'
+        elif '-' in aas:
+            aas = 'd'
+        prepared[position] = (wt, aas)
+    return prepared
+
+
 def score_single(HIVdb, drugname, seq_mutations):
     """ score_single function first checks if the drug is in the HIVdb
         if found, calculates score with a given drug and sequence according to Stanford algorithm
 
-        @param drugname: name of the drug you want the score for
-        @param sequence: user provided sequence of type str (tolerates whitespace on either side, will strip it out later)
+        @param drugname: name (or full name) of the drug you want the score for
+        @param seq_mutations: sequence mutations as returned by prepare_mutations()
         @return score: calculated drm mutation score
     """
+    drugname = HIVdb.drug_aliases.get(drugname, drugname)
     assert drugname in HIVdb.drugs.keys(), "Drugname: %s not found." % drugname
     rec = lambda x: sum(map(rec, x)) if isinstance(x, list) else x
 
@@ -32,27 +52,9 @@ def score_single(HIVdb, drugname, seq_mutations):
     sequence_DRMs = []
     sequence_DRM_positions = []
 
-    for condition in HIVdb.drugs[drugname][0]: # condition = potential DRMs associated with each drug
-        penalties = []
-        residueAAtuples = []
-
-        # separating penalty values from groups of tuples in each condition, both appended to lists
-        for gv_pairs in condition:
-            # 'AND' or 'single-drm' condition
-            if isinstance(gv_pairs, str):
-                if gv_pairs == 'value':
-                    penalties.append(condition[gv_pairs])
-                else:
-                    residueAAtuples.append(condition[gv_pairs])
-            # 'MAX' or 'MAXAND' condition
-            else:
-                for item in gv_pairs:
-                    if item == 'value':
-                        penalties.append(gv_pairs[item])
-                    else:
-                        residueAAtuples.append(gv_pairs[item])
-
-        # iterate thru conditions e.g. ([(41, 'L'), (215, 'FY')])
+    # penalty values and groups of tuples of each condition were separated by HIVdb.parse_drugs
+    for penalties, residueAAtuples in HIVdb.drug_conditions[drugname]:
+        # iterate thru conditions e.g. ([(41, <mask of 'L'>), (215, <mask of 'FY'>)])
         for i, residueAAtuple in enumerate(residueAAtuples):
             condition_present = True
             DRM_mutations = []
@@ -61,20 +63,17 @@ def score_single(HIVdb, drugname, seq_mutations):
             # iterate thru DRM tuples in each condition
             for j, mutationpair in enumerate(residueAAtuple):
                 position = mutationpair[0]  #e.g. 41
-                aminoacidlist = mutationpair[1]  #e.g. 'L'
+                aminoacidmask = mutationpair[1]  #e.g. HIVdb.aa_mask('L')
 
                 DRM_present = False  # assume DRM unfulfilled
                 if position in seq_mutations:
+                    wt, aas = seq_mutations[position]
                     # check if the position in the DRM is DRM_present in the sequence mutation list
-                    for seq_mutation in seq_mutations[position][1]:
-                        if '-' in seq_mutations[position][1]:
-                            seq_mutation = 'd'
-                        if '_' in seq_mutations[position][1]:
-                            seq_mutation = 'i'
-                        if seq_mutation in aminoacidlist:
+                    for seq_mutation in aas:
+                        if (aminoacidmask >> ord(seq_mutation)) & 1:
                             if not position in DRM_positions:
                                 # and not DRM_positions+[residue] in sequence_DRM_positions:
-                                mut = str(seq_mutations[position][0]) + str(position) + str(seq_mutation)
+                                mut = str(wt) + str(position) + str(seq_mutation)
                                 DRM_positions.append(position)
                                 DRM_mutations.append(mut)
                                 DRM_present = True
@@ -97,7 +96,6 @@ def score_single(HIVdb, drugname, seq_mutations):
                 indices = [i for i, x in enumerate(sequence_DRM_positions) if x == combination_positions]
                 mx = rec(sequence_partial_scores[indices[0]])
                 max_index = indices[0]
-                # print(str(drugname), str(sequence_DRM_positions), str(indices), mx)
                 for j in indices:
                     if rec(sequence_partial_scores[j]) > mx:
                         mx = rec(sequence_partial_scores[j])
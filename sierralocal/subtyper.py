@@ -1,12 +1,15 @@
 from pathlib import Path
 import csv
-import os
+from operator import itemgetter
 #import re
 import sys
 from sierralocal.utils import get_input_sequences
 #from sierralocal.nucaminohook import NucAminoAligner
 from time import time
 
+# package data directory, located once at import
+_DATA_DIR = Path(__file__).parent/'data'
+
 class Subtyper():
     def __init__(self):
         self.ambiguities = {
@@ -28,7 +31,7 @@ class Subtyper():
         :return: a dictionary of label:sequence pairs
         """
         # FIXME: this is a hard-coded data filename
-        filepath = Path(os.path.dirname(__file__))/'data'/'genotype-references.9c610d61.fasta'
+        filepath = _DATA_DIR/'genotype-references.9c610d61.fasta'
         handle = open(str(filepath))
         result = get_input_sequences(handle, return_dict=True)
         for label, seq in result.items():
@@ -38,6 +41,41 @@ class Subtyper():
             self.simple_subtypes[subtype].append(label)
         return result
 
+    def groupDifferences(self, seq, offset=0):
+        """
+        Group the positions of a query sequence by base, ignoring gaps, so that it can be
+        compared with many references by countDifferences().  A reference base differs
+        if it is neither the query base nor one of its ambiguities.
+
+        :param seq:  query nucleotide sequence
+        :param offset:  position in the references of the first base of seq
+        :return:  list of (getter of reference bases, table deleting matching bases) pairs
+                  for each distinct query base
+        """
+        positions = {}
+        for idx, nuc in enumerate(seq):
+            if nuc != '-':
+                positions.setdefault(nuc, []).append(offset+idx)
+        return [
+            (itemgetter(*idxs), str.maketrans('', '', self.ambiguities[nuc] + nuc))
+            for nuc, idxs in positions.items()
+        ]
+
+    @staticmethod
+    def countDifferences(differences, ref):
+        """
+        Count the base differences from a reference, gathering the reference bases at
+        the grouped positions rather than looping over positions in Python.
+
+        :param differences:  grouped query positions, from groupDifferences()
+        :param ref:  reference sequence
+        :return:  number of base differences
+        """
+        count = 0
+        for bases, matching in differences:
+            count += len(''.join(bases(ref)).translate(matching))
+        return count
+
     def uncorrectedDistance(self, seq, ref):
         """
         p-distance for nucleotide sequences.
@@ -49,15 +87,7 @@ class Subtyper():
         :return:  proportion of base differences
         """
         # TODO: Step 1: mask SDRM in seq with ref nucleotide
-        count = 0
-        for idx, nuc in enumerate(seq):
-            # print(idx, nuc)
-            rnuc = ref[idx]
-            if nuc == '-' or nuc == rnuc:
-                continue
-            if not ref[idx] in self.ambiguities[nuc]:
-                count += 1
-        return count / len(seq.strip('-'))
+        return self.countDifferences(self.groupDifferences(seq), ref) / len(seq.strip('-'))
 
     def getDistances(self, sequence, offset=0):
         """
@@ -69,10 +99,14 @@ class Subtyper():
                         upstream nucleotides so we shift the reference
         :return: a dictionary of (sequence label, distance) key-value pairs
         """
+        # group the query positions once, for all references
+        differences = self.groupDifferences(sequence, offset)
+        length = len(sequence.strip('-'))
+
         dists = {}
         #TODO: generate concatenated sequences, with masked SDRMS
         for header, reference in self.subtype_references.items():
-            dists[header] = self.uncorrectedDistance(sequence, reference[offset:])
+            dists[header] = self.countDifferences(differences, reference) / length
         return dists
 
 
@@ -82,7 +116,7 @@ class Subtyper():
         :return:  A nested dictionary keyed by subtype/CRF name
         """
         # FIXME: this is a hard-coded path
-        filepath = str(Path(os.path.dirname(__file__))/'data'/ 'genotype-properties.cc00f512.csv')
+        filepath = str(_DATA_DIR/'genotype-properties.cc00f512.csv')
         props = {}
         with open(filepath) as file:
             reader = csv.DictReader(file, delimiter='\t')
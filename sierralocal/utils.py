@@ -1,31 +1,38 @@
-def get_input_sequences(handle, return_dict=False):
+def fasta_iter(handle):
     """
-    Parse open file as FASTA, return a list of sequences.
+    Parse open file as FASTA, yielding one record at a time so that only the current
+    sequence is held in memory.
 
     :param handle:  Open stream to FASTA file in read mode
-    :param return_dict:  Option to return a dictionary of sequences keyed by header
-    :return:  if return_dict is True, returns dictionary; else a list of sequences
+    :yield:  (header, sequence) tuples in file order
     """
-    headers = []
-    sequences = []
-
     header = ''
-    sequence = ''
+    lines = []  # joined once per record, rather than concatenating line by line
     for line in handle:
         if line.startswith('$'):
             # skip comment
             continue
         elif line.startswith('>') or line.startswith('#'):
+            sequence = ''.join(lines)
             if len(sequence) > 0:
-                headers.append(header)
-                sequences.append(sequence)
-                sequence = ''  # reset
+                yield header, sequence.upper()
+            lines = []  # reset
             header = line.strip('>#\n')
         else:
-            sequence += line.strip('\n').upper()
+            lines.append(line.strip('\n'))
 
     # handle last entry
-    headers.append(header)
-    sequences.append(sequence)
+    yield header, ''.join(lines).upper()
+
+
+def get_input_sequences(handle, return_dict=False):
+    """
+    Parse open file as FASTA, return a list of sequences.
 
-    return dict(zip(headers, sequences)) if return_dict else sequences
+    :param handle:  Open stream to FASTA file in read mode
+    :param return_dict:  Option to return a dictionary of sequences keyed by header
+    :return:  if return_dict is True, returns dictionary; else a list of sequences
+    """
+    if return_dict:
+        return dict(fasta_iter(handle))
+    return [sequence for _, sequence in fasta_iter(handle)]